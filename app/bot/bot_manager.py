@@ -10,6 +10,7 @@ from pathlib import Path
 
 import httpx
 from aiogram import Bot, Dispatcher
+from aiogram.exceptions import TelegramRetryAfter
 from aiogram.types import Message, KeyboardButton, ReplyKeyboardMarkup, InlineKeyboardButton, InlineKeyboardMarkup
 from aiogram.filters import Command, CommandStart
 from aiogram.fsm.context import FSMContext
@@ -19,15 +20,33 @@ from aiogram.utils.keyboard import InlineKeyboardBuilder
 
 from app.config import Settings
 from app.models.user import UserData
-from app.services.database import UserDatabase
+from app.services.database import UserDatabase, write_json_atomic
 from app.services.imei_checker import IMEIChecker
 from app.services.imei_validator import IMEIValidator
 from app.services.response_formatter import ResponseFormatter
 from app.services.autopinger import AutoPinger
+from app.services.rate_limiter import TokenBucket
 from app.data.services_data import SERVICES_DATA
 
 logger = logging.getLogger(__name__)
 
+CATEGORY_EMOJI = {"Apple": "🍎", "Android": "🤖", "General": "🔧"}
+
+# Stateless main menu, built once and reused by every handler
+MAIN_MENU = ReplyKeyboardMarkup(
+    keyboard=[
+        [KeyboardButton(text="🔍 Consultar IMEI")],
+        [KeyboardButton(text="👤 Mi Cuenta"), KeyboardButton(text="❓ Ayuda")],
+        [KeyboardButton(text="❌ Cancelar")]
+    ],
+    resize_keyboard=True
+)
+
+
+def _clip(text: str, limit: int) -> str:
+    """Truncate text to limit chars, adding an ellipsis only when cut"""
+    return text if len(text) <= limit else f"{text[:limit]}..."
+
 
 class IMEIStates(StatesGroup):
     waiting_for_service_category = State()
@@ -46,9 +65,25 @@ class IMEIBot:
         self.dp = Dispatcher(storage=MemoryStorage())
         self.db = UserDatabase(config.users_db_path)
         self.autopinger = AutoPinger(config, self.bot)
+        # Shared client so IMEI API connections are kept alive between queries
+        self.imei_checker = IMEIChecker(config)
         self.services_by_id = {s["id"]: s for s in SERVICES_DATA}
         self.services_by_category = {}
         
+        # Shared pacing for bulk sends, below Telegram's ~30 msg/s per-bot limit
+        self.send_bucket = TokenBucket(rate=28, capacity=30)
+        
+        # Serialises services.json writes from concurrent add/remove commands
+        self._services_save_lock = asyncio.Lock()
+        
+        # Background queue for user notifications sent outside handlers
+        self._notify_queue: asyncio.Queue = asyncio.Queue()
+        self._notify_task: Optional[asyncio.Task] = None
+        
+        # Inline keyboards only change when services are added/removed
+        self._categories_keyboard: Optional[InlineKeyboardMarkup] = None
+        self._services_keyboards: Dict[str, InlineKeyboardMarkup] = {}
+        
         # Load services from file if exists
         self._load_services()
         
@@ -63,23 +98,36 @@ class IMEIBot:
 
     def _setup_handlers(self):
         """Setup bot handlers"""
-        self.dp.message(CommandStart())(self.cmd_start)
-        self.dp.message(Command("help"))(self.cmd_help)
-        self.dp.message(Command("ping"))(self.cmd_ping)
-        self.dp.message(Command("cancel"))(self.cmd_cancel)
-        self.dp.message(Command("account"))(self.cmd_account)
-        self.dp.message(Command("addbalance"))(self.cmd_add_balance)
-        self.dp.message(Command("addservice"))(self.cmd_add_service)
-        self.dp.message(Command("removeservice"))(self.cmd_remove_service)
-        self.dp.message(Command("listservices"))(self.cmd_list_services)
-        self.dp.message(Command("stats"))(self.cmd_stats)
-        self.dp.message(Command("broadcast"))(self.cmd_broadcast)
-        
-        # AutoPinger commands
-        self.dp.message(Command("autopinger"))(self.cmd_autopinger)
-        self.dp.message(Command("autopingstart"))(self.cmd_autoping_start)
-        self.dp.message(Command("autopingstop"))(self.cmd_autoping_stop)
+        commands = (
+            ("help", self.cmd_help),
+            ("ping", self.cmd_ping),
+            ("cancel", self.cmd_cancel),
+            ("account", self.cmd_account),
+            ("addbalance", self.cmd_add_balance),
+            ("addservice", self.cmd_add_service),
+            ("removeservice", self.cmd_remove_service),
+            ("listservices", self.cmd_list_services),
+            ("stats", self.cmd_stats),
+            ("broadcast", self.cmd_broadcast),
+            # AutoPinger commands
+            ("autopinger", self.cmd_autopinger),
+            ("autopingstart", self.cmd_autoping_start),
+            ("autopingstop", self.cmd_autoping_stop),
+        )
         
+        self.dp.message(CommandStart())(self.cmd_start)
+        for name, handler in commands:
+            self.dp.message(Command(name))(handler)
+        
+        # Callback dispatch tables: exact callback_data first, then "<prefix>_<arg>"
+        self._callback_actions = {
+            "back_to_categories": self._on_back_to_categories,
+            "cancel": self._on_cancel_callback,
+        }
+        self._callback_prefixes = {
+            "cat": self._on_category_callback,
+            "svc": self._on_service_callback,
+        }
         self.dp.callback_query()(self.handle_callback_query)
         
         # FSM handlers
@@ -90,22 +138,65 @@ class IMEIBot:
         # Default handler
         self.dp.message()(self.handle_category_selection)
 
+    def notify_user(self, user_id: int, text: str):
+        """Queue an HTML message to a user; sent by a background worker"""
+        if self._notify_task is None or self._notify_task.done():
+            self._notify_task = asyncio.create_task(self._notify_worker())
+        self._notify_queue.put_nowait((user_id, text))
+
+    async def send_paced(self, chat_id: int, text: str, **kwargs):
+        """Send a message through the shared token bucket, retrying once on flood control"""
+        await self.send_bucket.acquire()
+        try:
+            return await self.bot.send_message(chat_id, text, **kwargs)
+        except TelegramRetryAfter as e:
+            self.send_bucket.pause(e.retry_after)
+            await self.send_bucket.acquire()
+            return await self.bot.send_message(chat_id, text, **kwargs)
+
+    async def _notify_worker(self):
+        while True:
+            user_id, text = await self._notify_queue.get()
+            try:
+                await self.send_paced(user_id, text, parse_mode="HTML")
+            except Exception as e:
+                logger.warning(f"Failed to notify user {user_id}: {e}")
+            finally:
+                self._notify_queue.task_done()
+
+    async def stop_notifier(self, timeout: float = 5.0):
+        """Drain queued notifications (up to timeout seconds), then stop the worker"""
+        if self._notify_task and not self._notify_task.done():
+            try:
+                await asyncio.wait_for(self._notify_queue.join(), timeout)
+            except asyncio.TimeoutError:
+                logger.warning(f"Dropping {self._notify_queue.qsize()} pending notifications")
+            self._notify_task.cancel()
+            try:
+                await self._notify_task
+            except asyncio.CancelledError:
+                pass
+
     def _is_owner(self, user_id: int) -> bool:
         return user_id == self.config.owner_id
 
     def _create_main_menu(self) -> ReplyKeyboardMarkup:
-        buttons = [
-            [KeyboardButton(text="🔍 Consultar IMEI")],
-            [KeyboardButton(text="👤 Mi Cuenta"), KeyboardButton(text="❓ Ayuda")],
-            [KeyboardButton(text="❌ Cancelar")]
-        ]
-        return ReplyKeyboardMarkup(keyboard=buttons, resize_keyboard=True)
+        return MAIN_MENU
+
+    def _invalidate_keyboards(self):
+        self._categories_keyboard = None
+        self._services_keyboards.clear()
 
     def _create_categories_keyboard(self) -> InlineKeyboardMarkup:
+        if self._categories_keyboard is None:
+            self._categories_keyboard = self._build_categories_keyboard()
+        return self._categories_keyboard
+
+    def _build_categories_keyboard(self) -> InlineKeyboardMarkup:
         builder = InlineKeyboardBuilder()
         
         for category in self.services_by_category.keys():
-            emoji = {"Apple": "🍎", "Android": "🤖", "General": "🔧"}.get(category, "📱")
+            emoji = CATEGORY_EMOJI.get(category, "📱")
             builder.button(text=f"{emoji} {category}", callback_data=f"cat_{category}")
         
         builder.button(text="❌ Cancelar", callback_data="cancel")
@@ -113,6 +204,15 @@ class IMEIBot:
         return builder.as_markup()
 
     def _create_services_keyboard(self, category: str) -> InlineKeyboardMarkup:
+        markup = self._services_keyboards.get(category)
+        if markup is None:
+            markup = self._build_services_keyboard(category)
+            # Only cache known categories; callback data comes from clients
+            if category in self.services_by_category:
+                self._services_keyboards[category] = markup
+        return markup
+
+    def _build_services_keyboard(self, category: str) -> InlineKeyboardMarkup:
         builder = InlineKeyboardBuilder()
         
         services = self.services_by_category.get(category, [])
@@ -251,10 +351,11 @@ class IMEIBot:
             first_name=message.from_user.first_name, last_name=message.from_user.last_name
         )
         
-        full_name = f"{user.first_name or ''} {user.last_name or ''}".strip()
-        username_text = f"@{user.username}" if user.username else "No definido"
+        # Names come from Telegram users: escape them for parse_mode="HTML"
+        full_name = html.escape(f"{user.first_name or ''} {user.last_name or ''}".strip())
+        username_text = f"@{html.escape(user.username)}" if user.username else "No definido"
         
-        account_text = (
+        parts = [
             f"👤 <b>Mi Cuenta</b>\n"
             f"━━━━━━━━━━━━━━━━━━━━\n"
             f"🆔 <b>ID:</b> <code>{user.user_id}</code>\n"
@@ -262,15 +363,15 @@ class IMEIBot:
             f"📱 <b>Usuario:</b> {username_text}\n"
             f"💰 <b>Balance:</b> ${user.balance:.2f}\n"
             f"📊 <b>Consultas:</b> {user.total_queries}\n"
-        )
+        ]
         
         if user.query_history:
-            account_text += f"\n📋 <b>Historial reciente:</b>\n"
+            parts.append(f"\n📋 <b>Historial reciente:</b>\n")
             for query in user.query_history[-3:]:
                 status_emoji = "✅" if query["success"] else "❌"
-                account_text += f"{status_emoji} ${query['price']} - IMEI: ...{query['imei']}\n"
+                parts.append(f"{status_emoji} ${query['price']} - IMEI: ...{query['imei']}\n")
         
-        await message.answer(account_text, parse_mode="HTML")
+        await message.answer("".join(parts), parse_mode="HTML")
 
     async def cmd_add_balance(self, message: Message):
         if not self._is_owner(message.from_user.id):
@@ -296,7 +397,7 @@ class IMEIBot:
             user = self.db.users[target_user_id]
             old_balance = user.balance
             user.balance += amount
-            self.db.save_users()
+            self.db.schedule_save()
             
             await message.answer(
                 f"✅ Balance actualizado\n"
@@ -351,7 +452,8 @@ class IMEIBot:
                 self.services_by_category[category] = []
             self.services_by_category[category].append(new_service)
             
-            self._save_services()
+            self._invalidate_keyboards()
+            await self._save_services()
             
             await message.answer(
                 f"✅ <b>Servicio agregado</b>\n"
@@ -396,7 +498,8 @@ class IMEIBot:
                 if not self.services_by_category[category]:
                     del self.services_by_category[category]
             
-            self._save_services()
+            self._invalidate_keyboards()
+            await self._save_services()
             
             await message.answer(
                 f"✅ <b>Servicio eliminado</b>\n"
@@ -419,14 +522,15 @@ class IMEIBot:
             await message.answer("📝 No hay servicios configurados.")
             return
         
-        services_text = f"📋 <b>Lista de Servicios ({len(SERVICES_DATA)})</b>\n\n"
+        parts = [f"📋 <b>Lista de Servicios ({len(SERVICES_DATA)})</b>\n\n"]
         
         for category in self.services_by_category:
-            services_text += f"📂 <b>{category}:</b>\n"
+            parts.append(f"📂 <b>{category}:</b>\n")
             for service in self.services_by_category[category]:
-                services_text += f"• ID {service['id']}: ${service['price']} - {service['title'][:40]}...\n"
-            services_text += "\n"
+                parts.append(f"• ID {service['id']}: ${service['price']} - {_clip(service['title'], 40)}\n")
+            parts.append("\n")
         
+        services_text = "".join(parts)
         if len(services_text) > 4000:
             services_text = services_text[:4000] + "\n<i>... lista truncada</i>"
         
@@ -438,19 +542,19 @@ class IMEIBot:
             await message.answer("❌ Sin permisos.")
             return
         
-        total_users = len(self.db.users)
-        total_queries = sum(user.total_queries for user in self.db.users.values())
-        total_balance = sum(user.balance for user in self.db.users.values())
+        user_stats = self.db.get_stats()
+        total_users = user_stats["total_users"]
+        total_queries = user_stats["total_queries"]
+        total_balance = user_stats["total_balance"]
+        most_active = user_stats["most_active"]
         total_services = len(SERVICES_DATA)
         
-        most_active = max(self.db.users.values(), key=lambda u: u.total_queries, default=None)
-        
         cat_counts = {cat: len(services) for cat, services in self.services_by_category.items()}
         
         autopinger_status = self.autopinger.get_status()
         ping_status = "🟢 Activo" if autopinger_status["running"] else "🔴 Inactivo"
         
-        stats_text = (
+        parts = [
             f"📊 <b>Estadísticas del Bot</b>\n"
             f"━━━━━━━━━━━━━━━━━━━━\n"
             f"👥 <b>Total usuarios:</b> {total_users}\n"
@@ -459,21 +563,21 @@ class IMEIBot:
             f"🛠️ <b>Total servicios:</b> {total_services}\n"
             f"📡 <b>AutoPing:</b> {ping_status} ({autopinger_status['ping_count']} pings)\n\n"
             f"📂 <b>Por categoría:</b>\n"
-        )
+        ]
         
         for category, count in cat_counts.items():
-            emoji = {"Apple": "🍎", "Android": "🤖", "General": "🔧"}.get(category, "📱")
-            stats_text += f"• {emoji} {category}: {count} servicios\n"
+            emoji = CATEGORY_EMOJI.get(category, "📱")
+            parts.append(f"• {emoji} {category}: {count} servicios\n")
         
         if most_active and most_active.total_queries > 0:
-            stats_text += (
+            parts.append(
                 f"\n🏆 <b>Usuario más activo:</b>\n"
-                f"👤 {most_active.first_name or 'Sin nombre'} "
+                f"👤 {html.escape(most_active.first_name or 'Sin nombre')} "
                 f"({most_active.user_id})\n"
                 f"📊 {most_active.total_queries} consultas\n"
             )
         
-        await message.answer(stats_text, parse_mode="HTML")
+        await message.answer("".join(parts), parse_mode="HTML")
 
     async def cmd_broadcast(self, message: Message):
         """Broadcast message - Owner only"""
@@ -500,15 +604,15 @@ class IMEIBot:
         except Exception as e:
             await message.answer(f"❌ Error: {str(e)}")
 
-    def _save_services(self):
-        """Save services to JSON file"""
-        try:
-            services_file = Path(self.config.services_db_path)
-            with open(services_file, 'w', encoding='utf-8') as f:
-                json.dump(SERVICES_DATA, f, indent=2, ensure_ascii=False)
-            logger.info("Services saved to file")
-        except Exception as e:
-            logger.error(f"Error saving services: {e}")
+    async def _save_services(self):
+        """Save services to JSON file without blocking the event loop"""
+        async with self._services_save_lock:
+            try:
+                services_file = Path(self.config.services_db_path)
+                await asyncio.to_thread(write_json_atomic, services_file, list(SERVICES_DATA))
+                logger.info("Services saved to file")
+            except Exception as e:
+                logger.error(f"Error saving services: {e}")
 
     def _load_services(self):
         """Load services from JSON file"""
@@ -550,45 +654,14 @@ class IMEIBot:
         try:
             data = callback_query.data
             
-            if data.startswith("cat_"):
-                category = data[4:]
-                await callback_query.message.edit_text(
-                    f"📱 <b>Servicios de {category}:</b>\n\nSelecciona el servicio:",
-                    reply_markup=self._create_services_keyboard(category),
-                    parse_mode="HTML"
-                )
-                await state.update_data(selected_category=category)
-                await state.set_state(IMEIStates.waiting_for_service)
-                
-            elif data.startswith("svc_"):
-                service_id = int(data[4:])
-                service = self.services_by_id.get(service_id)
-                
-                if service:
-                    await state.update_data(selected_service=service)
-                    await callback_query.message.edit_text(
-                        f"✅ <b>Servicio:</b> {service['title']}\n"
-                        f"💰 <b>Precio:</b> ${service['price']}\n\n"
-                        f"📟 Envía el <b>número IMEI</b> (8-17 dígitos):",
-                        parse_mode="HTML"
-                    )
-                    await state.set_state(IMEIStates.waiting_for_imei)
-                
-            elif data == "back_to_categories":
-                await callback_query.message.edit_text(
-                    "📱 <b>Selecciona una categoría:</b>",
-                    reply_markup=self._create_categories_keyboard(),
-                    parse_mode="HTML"
-                )
-                await state.set_state(IMEIStates.waiting_for_service_category)
-                
-            elif data == "cancel":
-                await callback_query.message.delete()
-                await callback_query.message.answer(
-                    "❌ Cancelado. ¿Qué deseas hacer?",
-                    reply_markup=self._create_main_menu()
-                )
-                await state.clear()
+            handler = self._callback_actions.get(data)
+            if handler:
+                await handler(callback_query, state)
+            else:
+                prefix, _, arg = data.partition("_")
+                handler = self._callback_prefixes.get(prefix)
+                if handler:
+                    await handler(callback_query, state, arg)
             
             await callback_query.answer()
             
@@ -596,6 +669,44 @@ class IMEIBot:
             logger.error(f"Error in callback: {e}")
             await callback_query.answer("❌ Error procesando solicitud")
 
+    async def _on_category_callback(self, callback_query, state: FSMContext, category: str):
+        await callback_query.message.edit_text(
+            f"📱 <b>Servicios de {category}:</b>\n\nSelecciona el servicio:",
+            reply_markup=self._create_services_keyboard(category),
+            parse_mode="HTML"
+        )
+        await state.update_data(selected_category=category)
+        await state.set_state(IMEIStates.waiting_for_service)
+
+    async def _on_service_callback(self, callback_query, state: FSMContext, service_id: str):
+        service = self.services_by_id.get(int(service_id))
+        
+        if service:
+            await state.update_data(selected_service=service)
+            await callback_query.message.edit_text(
+                f"✅ <b>Servicio:</b> {service['title']}\n"
+                f"💰 <b>Precio:</b> ${service['price']}\n\n"
+                f"📟 Envía el <b>número IMEI</b> (8-17 dígitos):",
+                parse_mode="HTML"
+            )
+            await state.set_state(IMEIStates.waiting_for_imei)
+
+    async def _on_back_to_categories(self, callback_query, state: FSMContext):
+        await callback_query.message.edit_text(
+            "📱 <b>Selecciona una categoría:</b>",
+            reply_markup=self._create_categories_keyboard(),
+            parse_mode="HTML"
+        )
+        await state.set_state(IMEIStates.waiting_for_service_category)
+
+    async def _on_cancel_callback(self, callback_query, state: FSMContext):
+        await callback_query.message.delete()
+        await callback_query.message.answer(
+            "❌ Cancelado. ¿Qué deseas hacer?",
+            reply_markup=self._create_main_menu()
+        )
+        await state.clear()
+
     async def handle_imei_input(self, message: Message, state: FSMContext):
         imei_input = message.text.strip()
         
@@ -639,8 +750,7 @@ class IMEIBot:
         )
 
         try:
-            async with IMEIChecker(self.config) as checker:
-                response = await checker.check_imei(clean_imei, service["id"])
+            response = await self.imei_checker.check_imei(clean_imei, service["id"])
                 
             formatted_response = ResponseFormatter.format_imei_response(response)
             await processing_msg.delete()
@@ -677,10 +787,11 @@ class IMEIBot:
             await self.autopinger.start()
         
         try:
-            await self.dp.start_polling(self.bot)
+            await self.dp.start_polling(self.bot, polling_timeout=self.config.polling_timeout)
         except Exception as e:
             logger.error(f"Critical error: {e}")
             raise
         finally:
             await self.autopinger.stop()
+            await self.imei_checker.close()
             await self.bot.session.close()
\ No newline at end of file
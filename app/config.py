@@ -18,6 +18,10 @@ class Settings(BaseSettings):
     webhook_url: str = Field("", env="WEBHOOK_URL")
     webhook_path: str = Field("/webhook", env="WEBHOOK_PATH")
     webhook_secret: str = Field("", env="WEBHOOK_SECRET")
+    max_concurrent_updates: int = Field(32, env="MAX_CONCURRENT_UPDATES")
+    
+    # Polling configuration (used when no webhook is set)
+    polling_timeout: int = Field(30, env="POLLING_TIMEOUT")
     
     # Bot settings
     owner_id: int = Field(7655366089, env="OWNER_ID")
@@ -3,9 +3,13 @@ import os
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
 import asyncio
+import atexit
 import logging
+import queue
 from contextlib import asynccontextmanager
-from typing import Dict, Any, Optional
+from itertools import islice
+from logging.handlers import QueueHandler, QueueListener
+from typing import Dict, Any, Optional, Set
 from pydantic import BaseModel
 import requests
 
@@ -52,15 +56,32 @@ console_handler.setFormatter(logging.Formatter("[%(levelname)s] %(message)s"))
 file_handler = logging.FileHandler("app.log")
 file_handler.setFormatter(logging.Formatter("[%(asctime)s] [%(levelname)s] %(message)s"))
 
-logger.addHandler(tg_handler)
-logger.addHandler(console_handler)
-logger.addHandler(file_handler)
+# Los handlers (Telegram, consola, archivo) escriben desde un hilo en segundo
+# plano para no bloquear el event loop en cada llamada a logger
+log_queue = queue.SimpleQueue()
+log_listener = QueueListener(
+    log_queue, tg_handler, console_handler, file_handler, respect_handler_level=True
+)
+log_listener.start()
+atexit.register(log_listener.stop)
+
+logger.addHandler(QueueHandler(log_queue))
 
 # ----------------------------
 # GLOBAL BOT INSTANCE
 # ----------------------------
 bot_instance: IMEIBot = None
 
+# Updates del webhook en proceso (referencias fuertes hasta que terminan)
+webhook_tasks: Set[asyncio.Task] = set()
+update_semaphore = asyncio.Semaphore(settings.max_concurrent_updates)
+WEBHOOK_DRAIN_TIMEOUT = 5.0
+# Updates pendientes admitidos (x max_concurrent_updates) antes de responder 503
+WEBHOOK_BACKLOG_FACTOR = 4
+
+# Broadcast: envíos en paralelo; el ritmo lo marca el token bucket del bot
+BROADCAST_CONCURRENCY = 3
+
 # ----------------------------
 # Pydantic models
 # ----------------------------
@@ -84,6 +105,28 @@ class UserRegistrationRequest(BaseModel):
     initial_credits: float = 0.0
     admin_key: str
 
+# ----------------------------
+# HELPERS
+# ----------------------------
+def user_summary(user) -> Dict[str, Any]:
+    return {
+        "user_id": user.user_id,
+        "username": user.username,
+        "first_name": user.first_name,
+        "last_name": user.last_name,
+        "join_date": user.join_date,
+        "last_activity": user.last_activity,
+        "total_queries": user.total_queries,
+        "balance": round(user.balance, 2)
+    }
+
+async def process_update(update: types.Update):
+    async with update_semaphore:
+        try:
+            await bot_instance.dp.feed_update(bot_instance.bot, update)
+        except Exception as e:
+            logger.error(f"Update processing error: {e}")
+
 # ----------------------------
 # FASTAPI LIFESPAN
 # ----------------------------
@@ -100,7 +143,8 @@ async def lifespan(app: FastAPI):
             webhook_url = f"{settings.webhook_url.rstrip('/')}{settings.webhook_path}"
             await bot_instance.bot.set_webhook(
                 url=webhook_url,
-                secret_token=settings.webhook_secret if settings.webhook_secret else None
+                secret_token=settings.webhook_secret if settings.webhook_secret else None,
+                allowed_updates=bot_instance.dp.resolve_used_update_types()
             )
             logger.info(f"✅ Webhook set to: {webhook_url}")
         else:
@@ -119,8 +163,19 @@ async def lifespan(app: FastAPI):
         raise
     finally:
         logger.info("🛑 Shutting down...")
+        if webhook_tasks:
+            # Espera acotada: una consulta IMEI con reintentos no debe bloquear el cierre
+            _, pending = await asyncio.wait(webhook_tasks, timeout=WEBHOOK_DRAIN_TIMEOUT)
+            if pending:
+                logger.warning(f"Cancelling {len(pending)} in-flight updates")
+                for task in pending:
+                    task.cancel()
+                await asyncio.gather(*pending, return_exceptions=True)
         if bot_instance:
             await bot_instance.autopinger.stop()
+            await bot_instance.stop_notifier()
+            await bot_instance.imei_checker.close()
+            await bot_instance.db.flush()
             await bot_instance.bot.session.close()
         logger.info("✅ Shutdown complete")
 
@@ -177,10 +232,18 @@ async def webhook(request: Request):
             secret_header = request.headers.get("X-Telegram-Bot-Api-Secret-Token")
             if secret_header != settings.webhook_secret:
                 raise HTTPException(status_code=401, detail="Invalid secret token")
+        if len(webhook_tasks) >= settings.max_concurrent_updates * WEBHOOK_BACKLOG_FACTOR:
+            # Backpressure: Telegram reintenta la entrega más tarde
+            raise HTTPException(status_code=503, detail="Too many pending updates")
         update_data = await request.json()
         update = types.Update(**update_data)
-        await bot_instance.dp.feed_update(bot_instance.bot, update)
+        # Responder a Telegram de inmediato; el handler corre en segundo plano
+        task = asyncio.create_task(process_update(update))
+        webhook_tasks.add(task)
+        task.add_done_callback(webhook_tasks.discard)
         return {"status": "ok"}
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Webhook error: {e}")
         raise HTTPException(status_code=400, detail=f"Webhook processing failed: {str(e)}")
@@ -190,9 +253,10 @@ async def get_stats():
     if not bot_instance:
         raise HTTPException(status_code=503, detail="Bot not initialized")
     try:
-        total_users = len(bot_instance.db.users)
-        total_queries = sum(user.total_queries for user in bot_instance.db.users.values())
-        total_balance = sum(user.balance for user in bot_instance.db.users.values())
+        user_stats = bot_instance.db.get_stats()
+        total_users = user_stats["total_users"]
+        total_queries = user_stats["total_queries"]
+        total_balance = user_stats["total_balance"]
         total_services = len(bot_instance.services_by_id)
         
         services_by_category = {cat: len(svc) for cat, svc in bot_instance.services_by_category.items()}
@@ -222,19 +286,15 @@ async def add_credits(request: AddCreditsRequest):
         user = bot_instance.db.users[request.user_id]
         old_balance = user.balance
         user.balance += request.credits
-        bot_instance.db.save()
-        try:
-            await bot_instance.bot.send_message(
-                request.user_id,
-                f"💰 <b>¡Créditos añadidos!</b>\n\n"
-                f"• <b>Créditos recibidos:</b> +{request.credits}\n"
-                f"• <b>Balance anterior:</b> {old_balance}\n"
-                f"• <b>Nuevo balance:</b> {user.balance}\n"
-                f"• <b>Motivo:</b> {request.reason}",
-                parse_mode="HTML"
-            )
-        except Exception as e:
-            logger.warning(f"Failed to notify user {request.user_id}: {e}")
+        bot_instance.db.schedule_save()
+        bot_instance.notify_user(
+            request.user_id,
+            f"💰 <b>¡Créditos añadidos!</b>\n\n"
+            f"• <b>Créditos recibidos:</b> +{request.credits}\n"
+            f"• <b>Balance anterior:</b> {old_balance}\n"
+            f"• <b>Nuevo balance:</b> {user.balance}\n"
+            f"• <b>Motivo:</b> {request.reason}"
+        )
         logger.info(f"Added {request.credits} credits to user {request.user_id}. New balance: {user.balance}")
         return {"status":"success","user_id":request.user_id,"credits_added":request.credits,
                 "old_balance":old_balance,"new_balance":user.balance,"reason":request.reason}
@@ -256,18 +316,14 @@ async def set_credits(request: SetCreditsRequest):
         user = bot_instance.db.users[request.user_id]
         old_balance = user.balance
         user.balance = request.credits
-        bot_instance.db.save()
-        try:
-            await bot_instance.bot.send_message(
-                request.user_id,
-                f"💳 <b>Balance actualizado</b>\n\n"
-                f"• <b>Balance anterior:</b> {old_balance}\n"
-                f"• <b>Nuevo balance:</b> {user.balance}\n"
-                f"• <b>Motivo:</b> {request.reason}",
-                parse_mode="HTML"
-            )
-        except Exception as e:
-            logger.warning(f"Failed to notify user {request.user_id}: {e}")
+        bot_instance.db.schedule_save()
+        bot_instance.notify_user(
+            request.user_id,
+            f"💳 <b>Balance actualizado</b>\n\n"
+            f"• <b>Balance anterior:</b> {old_balance}\n"
+            f"• <b>Nuevo balance:</b> {user.balance}\n"
+            f"• <b>Motivo:</b> {request.reason}"
+        )
         logger.info(f"Set credits for user {request.user_id} to {request.credits}. Old balance: {old_balance}")
         return {"status":"success","user_id":request.user_id,"old_balance":old_balance,
                 "new_balance":user.balance,"reason":request.reason}
@@ -297,7 +353,7 @@ async def register_user(request: UserRegistrationRequest):
             balance=request.initial_credits
         )
         bot_instance.db.users[request.user_id] = new_user
-        bot_instance.db.save()
+        bot_instance.db.schedule_save()
         logger.info(f"Manually registered user {request.user_id} with {request.initial_credits} initial credits")
         return {"status":"success","user_id":request.user_id,"username":request.username,
                 "initial_credits":request.initial_credits,"message":"User registered successfully"}
@@ -318,14 +374,7 @@ async def get_user_info(user_id: int, admin_key: str):
             raise HTTPException(status_code=404, detail="User not found")
         user = bot_instance.db.users[user_id]
         return {
-            "user_id": user.user_id,
-            "username": user.username,
-            "first_name": user.first_name,
-            "last_name": user.last_name,
-            "join_date": user.join_date,
-            "last_activity": user.last_activity,
-            "total_queries": user.total_queries,
-            "balance": round(user.balance, 2),
+            **user_summary(user),
             "is_active": hasattr(user, 'is_active') and user.is_active
         }
     except HTTPException:
@@ -341,12 +390,11 @@ async def delete_user(user_id: int, admin_key: str = Body(..., embed=True)):
     try:
         if admin_key != settings.admin_key:
             raise HTTPException(status_code=401, detail="Invalid admin key")
-        if user_id not in bot_instance.db.users:
+        user = bot_instance.db.users.pop(user_id, None)
+        if user is None:
             raise HTTPException(status_code=404, detail="User not found")
-        user = bot_instance.db.users[user_id]
         user_info = {"user_id": user.user_id,"username": user.username,"balance": user.balance,"total_queries": user.total_queries}
-        del bot_instance.db.users[user_id]
-        bot_instance.db.save()
+        bot_instance.db.schedule_save()
         logger.info(f"Deleted user {user_id} with balance {user_info['balance']}")
         return {"status":"success","message":"User deleted successfully","deleted_user":user_info}
     except HTTPException:
@@ -367,15 +415,21 @@ async def broadcast_message(request: Request):
             raise HTTPException(status_code=401, detail="Invalid admin key")
         if not message:
             raise HTTPException(status_code=400, detail="Message is required")
-        success_count, failed_count = 0,0
-        for user_id in bot_instance.db.users.keys():
-            try:
-                await bot_instance.bot.send_message(user_id, f"📢 <b>Mensaje del administrador:</b>\n\n{message}", parse_mode="HTML")
-                success_count += 1
-                await asyncio.sleep(0.05)
-            except Exception as e:
-                logger.warning(f"Failed to send to user {user_id}: {e}")
-                failed_count += 1
+        text = f"📢 <b>Mensaje del administrador:</b>\n\n{message}"
+        semaphore = asyncio.Semaphore(BROADCAST_CONCURRENCY)
+
+        async def send(user_id: int) -> bool:
+            async with semaphore:
+                try:
+                    await bot_instance.send_paced(user_id, text, parse_mode="HTML")
+                    return True
+                except Exception as e:
+                    logger.warning(f"Failed to send to user {user_id}: {e}")
+                    return False
+
+        results = await asyncio.gather(*(send(user_id) for user_id in list(bot_instance.db.users)))
+        success_count = sum(results)
+        failed_count = len(results) - success_count
         return {"status":"completed","success_count":success_count,"failed_count":failed_count,"total_users":len(bot_instance.db.users)}
     except HTTPException:
         raise
@@ -390,21 +444,12 @@ async def get_users(limit: int = 50, offset: int = 0, admin_key: str = None):
     try:
         if not admin_key or admin_key != settings.admin_key:
             raise HTTPException(status_code=401, detail="Invalid admin key")
-        users_list = list(bot_instance.db.users.values())
-        users_slice = users_list[offset:offset + limit]
-        users_data = []
-        for user in users_slice:
-            users_data.append({
-                "user_id": user.user_id,
-                "username": user.username,
-                "first_name": user.first_name,
-                "last_name": user.last_name,
-                "join_date": user.join_date,
-                "last_activity": user.last_activity,
-                "total_queries": user.total_queries,
-                "balance": round(user.balance, 2)
-            })
-        return {"users": users_data,"total":len(users_list),"offset":offset,"limit":limit,"has_more":offset+limit<len(users_list)}
+        if offset < 0 or limit < 0:
+            raise HTTPException(status_code=400, detail="offset and limit must be non-negative")
+        total = len(bot_instance.db.users)
+        users_slice = islice(bot_instance.db.users.values(), offset, offset + limit)
+        users_data = [user_summary(user) for user in users_slice]
+        return {"users": users_data,"total":total,"offset":offset,"limit":limit,"has_more":offset+limit<total}
     except HTTPException:
         raise
     except Exception as e:
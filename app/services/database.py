@@ -1,7 +1,10 @@
+import asyncio
 import json
 import logging
+import os
+import tempfile
 from pathlib import Path
-from typing import Dict, Optional
+from typing import Any, Dict, Optional
 from dataclasses import asdict
 from datetime import datetime
 
@@ -9,11 +12,41 @@ from app.models.user import UserData
 
 logger = logging.getLogger(__name__)
 
+# Read once at import: os.umask can only be queried by setting it, which is not thread-safe
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+
+
+def write_json_atomic(path: Path, data) -> None:
+    """Write JSON to a unique temp file, fsync it and atomically replace the target"""
+    # mkstemp creates 0600; keep the target's mode (or the umask default)
+    try:
+        mode = os.stat(path).st_mode & 0o777
+    except FileNotFoundError:
+        mode = 0o666 & ~_UMASK
+    fd, tmp_name = tempfile.mkstemp(dir=path.parent, prefix=f"{path.name}.", suffix=".tmp")
+    tmp_path = Path(tmp_name)
+    try:
+        with open(fd, 'w', encoding='utf-8') as f:
+            os.fchmod(f.fileno(), mode)
+            json.dump(data, f, indent=2, ensure_ascii=False)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    finally:
+        if tmp_path.exists():
+            tmp_path.unlink()
+
 
 class UserDatabase:
-    def __init__(self, db_path: str):
+    def __init__(self, db_path: str, save_delay: float = 0.5):
         self.db_path = Path(db_path)
         self.users: Dict[int, UserData] = {}
+        self.save_delay = save_delay
+        self._dirty = False
+        self._flush_handle: Optional[asyncio.TimerHandle] = None
+        self._save_task: Optional[asyncio.Task] = None
+        self._save_lock = asyncio.Lock()
         self.load_users()
 
     def load_users(self):
@@ -29,16 +62,75 @@ class UserDatabase:
                 logger.error(f"Error loading database: {e}")
                 self.users = {}
 
+    def _snapshot(self) -> Dict[str, Any]:
+        return {str(user_id): asdict(user_data) for user_id, user_data in self.users.items()}
+
     def save_users(self):
         """Save users to JSON file"""
         try:
             self.db_path.parent.mkdir(parents=True, exist_ok=True)
-            data = {str(user_id): asdict(user_data) for user_id, user_data in self.users.items()}
-            with open(self.db_path, 'w', encoding='utf-8') as f:
-                json.dump(data, f, indent=2, ensure_ascii=False)
+            write_json_atomic(self.db_path, self._snapshot())
+            self._dirty = False
         except Exception as e:
             logger.error(f"Error saving database: {e}")
 
+    async def save_users_async(self):
+        """Snapshot users on the loop and write the file in a worker thread"""
+        async with self._save_lock:
+            data = self._snapshot()
+            self._dirty = False
+            try:
+                self.db_path.parent.mkdir(parents=True, exist_ok=True)
+                await asyncio.to_thread(write_json_atomic, self.db_path, data)
+            except Exception as e:
+                self._dirty = True
+                logger.error(f"Error saving database: {e}")
+
+    def schedule_save(self):
+        """Mark users as dirty and coalesce saves into one write after save_delay"""
+        self._dirty = True
+        if self._flush_handle is not None:
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            # No event loop (e.g. scripts): save synchronously
+            self.save_users()
+            return
+        self._flush_handle = loop.call_later(self.save_delay, self._flush)
+
+    def _flush(self):
+        self._flush_handle = None
+        if self._dirty:
+            self._save_task = asyncio.get_running_loop().create_task(self.save_users_async())
+
+    async def flush(self):
+        """Write pending changes immediately (used on shutdown)"""
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        if self._dirty:
+            await self.save_users_async()
+        elif self._save_task is not None:
+            await self._save_task
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Aggregate user totals in a single pass"""
+        total_queries = 0
+        total_balance = 0.0
+        most_active = None
+        for user in self.users.values():
+            total_queries += user.total_queries
+            total_balance += user.balance
+            if most_active is None or user.total_queries > most_active.total_queries:
+                most_active = user
+        return {
+            "total_users": len(self.users),
+            "total_queries": total_queries,
+            "total_balance": total_balance,
+            "most_active": most_active
+        }
+
     def get_or_create_user(
         self, 
         user_id: int, 
@@ -57,13 +149,15 @@ class UserDatabase:
                 join_date=now,
                 last_activity=now
             )
-            self.save_users()
+            self.schedule_save()
         else:
-            # Update user info
+            # Update user info; last_activity alone rides along with the next real save
             user = self.users[user_id]
-            user.username = username
-            user.first_name = first_name
-            user.last_name = last_name
+            if (user.username, user.first_name, user.last_name) != (username, first_name, last_name):
+                user.username = username
+                user.first_name = first_name
+                user.last_name = last_name
+                self.schedule_save()
             user.last_activity = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
         
         return self.users[user_id]
@@ -97,4 +191,4 @@ class UserDatabase:
             if len(user.query_history) > 50:
                 user.query_history = user.query_history[-50:]
                 
-            self.save_users()
\ No newline at end of file
+            self.schedule_save()
\ No newline at end of file
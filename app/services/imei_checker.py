@@ -19,15 +19,26 @@ class IMEIChecker:
         self.session = None
 
     async def __aenter__(self):
-        self.session = httpx.AsyncClient(
-            timeout=httpx.Timeout(self.config.request_timeout),
-            limits=httpx.Limits(max_keepalive_connections=5, max_connections=10)
-        )
+        self._ensure_session()
         return self
 
     async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.close()
+
+    def _ensure_session(self):
+        """Create the pooled HTTP client on first use"""
+        if self.session is None:
+            # One client serves every concurrent update, so size the pool to match
+            pool_size = max(10, self.config.max_concurrent_updates)
+            self.session = httpx.AsyncClient(
+                timeout=httpx.Timeout(self.config.request_timeout),
+                limits=httpx.Limits(max_keepalive_connections=pool_size, max_connections=pool_size)
+            )
+
+    async def close(self):
         if self.session:
             await self.session.aclose()
+            self.session = None
 
     async def check_imei(self, imei: str, service_id: int) -> Dict[str, Any]:
         """Check IMEI using external API"""
@@ -37,6 +48,7 @@ class IMEIChecker:
             "imei": imei
         }
 
+        self._ensure_session()
         last_error = None
         for attempt in range(self.config.max_retries):
             try:
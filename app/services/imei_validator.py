@@ -1,6 +1,8 @@
 import re
 from typing import Tuple
 
+_NON_DIGIT_RE = re.compile(r'[^\d]')
+
 
 class IMEIValidator:
     @staticmethod
@@ -10,7 +12,7 @@ class IMEIValidator:
             return False, "IMEI no puede estar vacío"
         
         # Remove all non-digit characters
-        clean_imei = re.sub(r'[^\d]', '', imei)
+        clean_imei = _NON_DIGIT_RE.sub('', imei)
         
         if not clean_imei.isdigit():
             return False, "IMEI debe contener solo números"
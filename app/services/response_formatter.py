@@ -5,6 +5,8 @@ from typing import Dict, Any
 
 logger = logging.getLogger(__name__)
 
+_HTML_TAG_RE = re.compile(r'<[^>]*>')
+
 
 class ResponseFormatter:
     @staticmethod
@@ -64,7 +66,7 @@ class ResponseFormatter:
             decoded = decoded.replace(old, new)
         
         # Remove HTML tags
-        clean_text = re.sub(r'<[^>]*>', '', decoded)
+        clean_text = _HTML_TAG_RE.sub('', decoded)
         
         # Clean up lines
         lines = []